@@ -1,118 +1,218 @@
 '''
 Title: Multi-scale Multipopulation Epidemic Simulation with the SIRS model.
-Description: The simulation below uses a graphing library 'networkx' to simulate
-              the evolution of an epidemic over a global population that is comprised
-              of 4 local subpopulations. At the local level, the model assumes random
-              mixing and applies the SIRS epidemic model. At the global level, it allows
-              individuals to move from one population to another, simulating the notion of 
-              shortcuts in a small-world network.
+Description: The simulation below models the evolution of an epidemic over a global 
+              population that is comprised of 4 local subpopulations. At the local level, 
+              the model assumes random mixing and applies the SIRS epidemic model: each 
+              timestep every pair of individuals is in contact with probability gamma, so 
+              instead of building the contact graph the infection probability of a 
+              susceptible individual is computed in closed form from the number of infected 
+              individuals around it. At the global level, it allows individuals to move from 
+              one population to another, simulating the notion of shortcuts in a small-world 
+              network. The graphing library 'networkx' is only used to draw the subpopulations.
 Author: Eugene Halim
 '''
 # Imports
 import networkx as nx
 import matplotlib.pyplot as plt
-import random
-
-# Ask users for input
-gamma = input("Contact probability % (for 0.40 = 40% type '40'): ")
-while (not gamma.isdigit() or int(gamma) > 100 or int(gamma) < 0):
-  print("Please only input integer values between 0 and 100!")
-  gamma = input("Contact probability % (for 0.40 = 40% type '40'): ")
-
-beta = input("Infection probability % (for 0.40 = 40% type '40'): ")
-while (not beta.isdigit() or int(beta) > 100 or int(beta) < 0):
-  print("Please only input integer values between 0 and 100!")
-  beta = input("Infection probability % (for 0.40 = 40% type '40'): ")
-  
-recovery = input("Recovery rate % (for 0.40 = 40% type '40'): ")
-while (not recovery.isdigit() or int(recovery) > 100 or int(recovery) < 0):
-  print("Please only input integer values between 0 and 100!")
-  recovery = input("Recovery rate % (for 0.40 = 40% type '40'): ")
-
-move_probability = input("Probability (%) that a node moves to new context (for 0.40 = 40% type '40'): ")
-while (not move_probability.isdigit() or int(move_probability) > 100 or int(move_probability) < 0):
-  print("Please only input integer values between 0 and 100!")
-  move_probability = input("Probability (%) that a node moves to new context (for 0.40 = 40% type '40'): ")
-
-n = input("Population (integer) of each local context. Pick number between 0-50: ")
-while (not n.isdigit() or int(n) > 50 or int(n) < 0):
-  print("Please only input integer values between 0 and 50!")
-  n = input("Population (integer) of each local context. Pick number between 0-50: ")
-
-num_iter = input("How many iterations (integer):  ")
-while (not num_iter.isdigit() or int(num_iter) < 0):
-  print("Please only input integer values greater 0!")
-  num_iter = input("How many iterations (integer):  ")
-
-# Convert to integers
-gamma = float("0." + gamma)
-beta = float("0." + beta)
-recovery = float("0." + recovery)
-move_probability = float("0." + move_probability)
-n = int(n)
-num_iter = int(num_iter)
+import argparse
+import math
+from dataclasses import dataclass
+import numpy as np
+from numba import njit
+
+# Command line options
+def nonNegativeInt(s):
+  '''
+  Argparse type for options that take an integer greater than or equal to 0.
+  '''
+  if not s.isdigit():
+    raise argparse.ArgumentTypeError("expected an integer >= 0, got '" + s + "'")
+  return int(s)
+
+def positiveInt(s):
+  '''
+  Argparse type for options that take an integer greater than or equal to 1.
+  '''
+  if not s.isdigit() or int(s) < 1:
+    raise argparse.ArgumentTypeError("expected an integer >= 1, got '" + s + "'")
+  return int(s)
+
+parser = argparse.ArgumentParser(description="Multi-scale Multipopulation Epidemic Simulation with the SIRS model.")
+parser.add_argument("--draw-every", dest="draw_interval", type=nonNegativeInt, default=1, metavar="K",
+                    help="Draw the subpopulation graphs every K timesteps (0 only draws the last timestep).")
+parser.add_argument("--device", choices=["cpu", "cuda"], default="cpu",
+                    help="Run the simulation on the CPU, or on an NVIDIA GPU with CuPy (lifts the 50 node limit).")
+parser.add_argument("--seed", type=nonNegativeInt, default=None,
+                    help="Seed of the random number generator, to reproduce a run (random by default).")
+parser.add_argument("--jobs", type=positiveInt, default=1, metavar="J",
+                    help="Step the subpopulations in J worker processes (default 1, serial). Only pays off for "
+                         "very large subpopulations, since every timestep ships the states to the workers. "
+                         "Not available with --device cuda.")
+args = parser.parse_args()
+if args.jobs > 1 and args.device == "cuda":
+  parser.error("argument --jobs: not available with --device cuda")
+draw_interval = args.draw_interval
+device = args.device
+if device == "cuda":
+  import cupy as cp
+if args.jobs > 1:
+  from joblib import Parallel, delayed
+
+def askInt(prompt, lo, hi=None):
+  '''
+  Asks the user for an integer between lo and hi (inclusive) until a valid one is given.
+  Inputs:
+  - prompt: String, the question shown to the user.
+  - lo, hi: Integers, the allowed range. hi=None means there is no upper bound.
+
+  Outputs:
+  - Integer: The value the user typed.
+  '''
+  while True:
+    s = input(prompt)
+    if s.isdigit() and lo <= int(s) and (hi is None or int(s) <= hi):
+      return int(s)
+    if hi is None:
+      print("Please only input integer values greater " + str(lo) + "!")
+    else:
+      print("Please only input integer values between " + str(lo) + " and " + str(hi) + "!")
+
+# Ask users for input. Probabilities are typed as percentages.
+gamma = askInt("Contact probability % (for 0.40 = 40% type '40'): ", 0, 100) / 100
+beta = askInt("Infection probability % (for 0.40 = 40% type '40'): ", 0, 100) / 100
+recovery = askInt("Recovery rate % (for 0.40 = 40% type '40'): ", 0, 100) / 100
+move_probability = askInt("Probability (%) that a node moves to new context (for 0.40 = 40% type '40'): ", 0, 100) / 100
+if device == "cuda":
+  n = askInt("Population (integer) of each local context: ", 0)
+else:
+  n = askInt("Population (integer) of each local context. Pick number between 0-50: ", 0, 50)
+num_iter = askInt("How many iterations (integer):  ", 0)
 r_to_s = recovery
 
 # Global Variables
-graphs = [] # Array of dictionaries, one for each of the subpopulation graphs.
-global_susceptible = []
-global_infected = []
-global_recovered = []
-timesteps = []
+rng = np.random.default_rng(args.seed)
+if device == "cuda":
+  # The GPU step draws from CuPy's own generator, seeded from rng.
+  cp.random.seed(int(rng.integers(2**32)))
+else:
+  subpopulation_rngs = rng.spawn(4) # One independent random stream per subpopulation.
+  drawing_rng = rng.spawn(1)[0] # Separate stream for the drawn graphs, so drawing does not change the simulation.
+  # Worker pool used to step the subpopulations concurrently with --jobs, otherwise they are stepped serially.
+  parallel = Parallel(n_jobs=args.jobs, backend="loky") if args.jobs > 1 else None
+graphs = [] # Array of Subpopulation objects, one for each of the subpopulation graphs.
+# Node states, stored per subpopulation as an int8 array indexed by node.
+SUSCEPTIBLE = 0
+INFECTED = 1
+RECOVERED = 2
+STATE_COLORS = np.array(['orange', 'red', 'green'])
+# Subgroups each subgroup can move to: the one that is distance 1 away, then the two that are distance 2 away.
+MOVE_DESTINATIONS = np.array([[2, 3, 4], [1, 3, 4], [4, 1, 2], [3, 1, 2]])
+MOVE_CUMULATIVE = np.array([0.5, 0.75, 1.0])
+DRAW_RANGE = 1 << 32 # Random draws of the SIRS step are 32-bit integers.
+MAX_DRAWN_POPULATION = 200 # Larger subpopulations (only possible with --device cuda) are not drawn as graphs.
+# Global S,I,R populations at each timestep, preallocated for all the iterations.
+global_susceptible = np.empty(num_iter + 1, dtype=np.int64)
+global_infected = np.empty(num_iter + 1, dtype=np.int64)
+global_recovered = np.empty(num_iter + 1, dtype=np.int64)
+timesteps = np.arange(num_iter + 1)
 
 '''
 FUNCTION DEFINITIONS
 '''
-def generateErdosRenyi(susceptible, infected, recovered, p):
+@dataclass(slots=True)
+class Subpopulation:
+  '''
+  State of one subpopulation (local context).
+  - state: int8 numpy array, the state (SUSCEPTIBLE, INFECTED or RECOVERED) of each individual.
+  - counts: int64 numpy array, the number of susceptible, infected and recovered individuals.
+  With --device cuda the states stay on the GPU (see "performGlobalIterationCuda") and state is None.
+  - pos: (N, 2) numpy array, the drawing position of each individual. Computed the first time the
+         subpopulation is drawn, then kept for the individuals that stay.
+  '''
+  state: np.ndarray
+  counts: np.ndarray
+  pos: np.ndarray = None
+
+def generateErdosRenyi(state, p, rng):
   '''
-  Function that generates a random graph. It first adds a total of N = susceptible + infected + recovered
-  nodes into the graph (with appropiate labels), then it randomly adds edegs between all pairs of nodes 
-  with probability p. 
+  Function that generates a random graph. It considers a total of N = len(state) nodes, then it 
+  randomly adds edegs between all pairs of nodes with probability p. The graph is returned in 
+  compressed sparse row (CSR) form: the neighbors of node i are neighbors[offsets[i]:offsets[i+1]].
   Inputs:
-  - Susceptible: Integer, number of susceptible individuals in subpopulatoin.
-  - Infected: Integer, number of infected individuals in subpopulatoin.
-  - Recovered: Integer, number of recovered individuals in subpopulatoin.
+  - state: int8 numpy array, the state (SUSCEPTIBLE, INFECTED or RECOVERED) of each individual in 
+           the subpopulation. Node i of the graph is the individual state[i].
   - p: Float between 0 and 1, contact probability between individuals in the same graph. 
+  - rng: The numpy random Generator of the subpopulation.
+
+  Outputs:
+  - offsets: int32 numpy array of length N + 1, where each node's neighbors start in "neighbors".
+  - neighbors: int32 numpy array, the neighbors of every node, one after the other. Every edge 
+               appears twice, once for each of its endpoints.
+  '''
+
+  # Find total populatoin in graph
+  N = len(state)
+
+  # Sample the edges with the Batagelj-Brandes method: instead of drawing a random number for
+  # every pair of nodes, draw the (geometrically distributed) gap to the next edge, so the work
+  # done is proportional to the number of edges rather than to N^2. Pairs (v, w) with w < v are 
+  # numbered row by row, so pair number m is v = floor((1 + sqrt(1 + 8m)) / 2), w = m - v(v-1)/2.
+  M = N * (N - 1) // 2
+  if p >= 1:
+    pairs = np.arange(M, dtype=np.int64)
+  elif p > 0:
+    lp = math.log(1.0 - p)
+    chunks = []
+    last = -1
+    # Draw the gaps in batches sized to the expected number of remaining edges.
+    while last < M:
+      size = int((M - last) * p * 1.1) + 16
+      gaps = 1 + np.floor(np.log(1.0 - rng.random(size)) / lp).astype(np.int64)
+      positions = last + np.cumsum(gaps)
+      chunks.append(positions[positions < M])
+      last = positions[-1]
+    pairs = np.concatenate(chunks)
+  else:
+    pairs = np.zeros(0, dtype=np.int64)
+  v = ((1 + np.sqrt(1 + 8 * pairs)) // 2).astype(np.int64)
+  # Correct for rounding in the square root.
+  v[v * (v - 1) // 2 > pairs] -= 1
+  v[v * (v + 1) // 2 <= pairs] += 1
+  w = pairs - v * (v - 1) // 2
+
+  # Store each edge in both directions, then group the edges by their source node.
+  i = np.concatenate([v, w]).astype(np.int32)
+  j = np.concatenate([w, v]).astype(np.int32)
+  neighbors = j[np.argsort(i, kind='stable')]
+  offsets = np.zeros(N + 1, dtype=np.int32)
+  offsets[1:] = np.bincount(i, minlength=N).cumsum()
+
+  return offsets, neighbors
+
+def buildNetworkxGraph(state, offsets, neighbors):
+  '''
+  Converts a subpopulation into a networkx graph so that it can be drawn. The simulation itself 
+  never builds the graph (see "performGraphIteration").
+  Inputs:
+  - state: int8 numpy array, the state of each individual in the subpopulation.
+  - offsets, neighbors: The CSR adjacency of the subpopulation (see "generateErdosRenyi").
 
   Outputs:
   - G: The networkx graph object.
   - Colormap: Colors to assign to each individual node in graph. Creates visual distinction between different
               node states.
   '''
-
-  # Find total populatoin in graph
-  N = susceptible + infected + recovered
-  # Create an empty graph
+  N = len(state)
   G = nx.Graph()
-
-  color_map = []
-
-  # Iterate through each node, adding labels and colors 
-  for i in range(N):
-    if i < susceptible:
-      G.add_node(i, label="susceptible")
-      color_map.append('orange')
-
-    elif i < susceptible + infected: 
-      G.add_node(i, label="infected")
-      color_map.append('red')      
-    else:
-      G.add_node(i, label="recovered")
-      color_map.append('green')
-
-  # iterate between all pairs of nodes (i, j)
-  for i in range(0, N):
-    for j in range(i+1, N):
-      # pick a random number and if it is less than p add an edge
-      if random.random() < p:
-        G.add_edge(i, j)
-
-  # Return the graph with edges and color map
+  G.add_nodes_from(range(N))
+  sources = np.repeat(np.arange(N), np.diff(offsets))
+  G.add_edges_from(zip(sources.tolist(), neighbors.tolist()))
+  color_map = STATE_COLORS[state].tolist()
   return G, color_map
 
-def findContextToMoveTo(group_num):
+def findContextToMoveTo(group_num, rng, size):
   '''
-  Finds which subpopulation an individual from a given group will move to. The sampling 
+  Finds which subpopulation individuals from a given group will move to. The sampling 
   function is a simplified version of the actual multiscale metapopulatin model - groups 
   that are a distance x from the current group are chosen with probability 1/2^x. The 
   mapping below was written or a global population with only 4 subpopulaton, where the 
@@ -123,212 +223,281 @@ def findContextToMoveTo(group_num):
                   /\  /\
                  1 2 3 4
   Inputs:
-  - group_num: The subgroup that the individual is currently in.
+  - group_num: The subgroup that the individuals are currently in.
+  - rng: The numpy random Generator of the subgroup.
+  - size: Integer, the number of individuals moving out of the subgroup.
 
   Outputs:
-  - Integer: The subgroup that the given individual is moving to. 
+  - Integer numpy array: The subgroup that each of the given individuals is moving to. 
   '''
 
-  # Generate a random number
-  sampler = random.random()
-
-  # With probability 50%, return the group that is distance 1 away. 
-  if (sampler <= 0.5):
-    if (group_num == 1):
-      return 2
-    elif (group_num == 2):
-      return 1
-    elif (group_num == 3):
-      return 4
-    elif (group_num == 4):
-      return 3
-    
-  # With probability 25%, return a group that is distance 2 away.
-  elif(sampler > 0.5 and sampler <=0.75):
-    if (group_num == 1):
-      return 3
-    elif (group_num == 2):
-      return 3
-    elif (group_num == 3):
-      return 1
-    elif (group_num == 4):
-      return 1
-    
-  # With probability 25%, return the second group tat is distance 2 away.
-  else:
-    if (group_num == 1):
-      return 4
-    elif (group_num == 2):
-      return 4
-    elif (group_num == 3):
-      return 2
-    elif (group_num == 4):
-      return 2
-   
-
-def performGraphIteration(g, num_graph):
+  # Generate a random number for each individual, and find which bucket of MOVE_CUMULATIVE it falls in:
+  # with probability 50% the group that is distance 1 away, with probability 25% each of the two groups
+  # that are distance 2 away.
+  sampler = rng.random(size)
+  bucket = np.searchsorted(MOVE_CUMULATIVE, sampler)
+  return MOVE_DESTINATIONS[group_num - 1, bucket]
+
+@njit(cache=True)
+def stepStates(state, draws, infection_threshold, recovery_threshold, r_to_s_threshold, move_threshold):
   '''
-  Runs the simulation for a single timestep for the given graph. Iterates through each node in the 
-  graph and decides the next state of the current node based on its current state and the probability
-  of state transitions that the user inputs. It updates both the local and global population statistics.
-  This function does not redraw the graph, but provides the necessary information for the "generateErdosRenyi"
-  function to generate the corresponding graph.
+  Compiled kernel that advances the states of a single subpopulation by one timestep. Each node
+  either moves to a new subpopulation (keeping its state), or goes through one SIRS transition:
+  infected nodes recover, recovered nodes become susceptible again, and susceptible nodes are 
+  infected. Each node's update only depends on its own state, so the states are updated in place.
 
   Inputs:
-  - g: the NetworkX graph object
-  - num_graph: The graph's position in the global list of graph dictionaries. 
+  - state: int8 numpy array, the state of each individual. Updated in-place.
+  - draws: (N, 4) uint32 numpy array of uniform random integers in [0, DRAW_RANGE), drawn in one batch
+           by the caller. Column 0 decides moves, 1 recoveries, 2 loss of immunity and 3 infections.
+  - infection_threshold, recovery_threshold, r_to_s_threshold, move_threshold: The transition 
+           probabilities scaled by DRAW_RANGE. A draw below the threshold means the transition happens.
 
-  Outputs: None. Performs updates in-place.
+  Outputs:
+  - move_mask: Boolean numpy array, True for each node that moves to a new subpopulation.
   '''
+  N = len(state)
+  move_mask = np.zeros(N, dtype=np.bool_)
 
-  # Get the statistics from the last timestep from the current graph's disctionary.
-  local_susceptible = graphs[num_graph]["susceptible"]
-  local_infected = graphs[num_graph]["infected"]
-  local_recovered = graphs[num_graph]["recovered"]
+  for node in range(N):
+    # Check if the node will move to a new subpopulation.
+    if draws[node, 0] < move_threshold:
+      move_mask[node] = True
+      continue
 
-  # Nodes to remove in case a node moves from the current subgroup to another.
-  nodes_to_remove = []
+    # If infected, check if node recovers within current timestep.
+    if state[node] == INFECTED:
+      if draws[node, 1] < recovery_threshold:
+        state[node] = RECOVERED
 
-  # iterate through each node
-  for node in g:
-    # Check if the node will move to a new subpopulation. 
-    if (random.random() < move_probability):
-      new_context = findContextToMoveTo(num_graph + 1)
+    # If recovered, check whether becomes susceptible again.
+    elif state[node] == RECOVERED:
+      if draws[node, 2] < r_to_s_threshold:
+        state[node] = SUSCEPTIBLE
 
-      # Add the current node with the current label to new graph and update population count.
-      graphs[new_context - 1]["graph"].add_node(node, label=g.nodes[node]['label'])
-      graphs[new_context - 1][g.nodes[node]['label']] = graphs[new_context - 1][g.nodes[node]['label']] + 1
+    # If susceptible, check if infected by neighbors based on probability given.
+    elif state[node] == SUSCEPTIBLE:
+      if draws[node, 3] < infection_threshold:
+        state[node] = INFECTED
 
-      # Save node information to remove later.
-      nodes_to_remove.append(node)
+  return move_mask
 
-    # If infected, check if node recovers within current timestep.
-    elif (g.nodes[node]['label'] == "infected" and random.random() < recovery): 
-      # Update node label and graph population statistics
-      g.nodes[node]['label'] = "recovered"
-      local_infected = local_infected - 1
-      local_recovered = local_recovered + 1
+def performGraphIteration(num_graph, state, params, rng):
+  '''
+  Runs the simulation for a single timestep for the given graph. Decides the next state of every node 
+  in the graph with the compiled "stepStates" kernel, based on its current state and the probability 
+  of state transitions that the user inputs. The function does not touch any global state, so the 
+  subpopulations can be stepped in parallel; moving nodes are returned to the caller, which adds them 
+  to their new subpopulations once every subpopulation has been stepped.
+  The graph itself is never built: since its edges are redrawn independently every timestep, each 
+  pair of a susceptible and an infected node is an edge with probability gamma, and the contact along 
+  it succeeds with probability beta. Keeping only the successful contacts leaves a random graph with 
+  edge probability gamma * beta, so a susceptible node is infected (has at least one successful 
+  contact with one of the I infected nodes) with probability 1 - (1 - gamma * beta)^I. 
+  "generateErdosRenyi" is only needed to draw the graph.
 
-    # If recovered, check whether becomes susceptible again.
-    elif (g.nodes[node]['label'] == "recovered" and random.random() < r_to_s):
-      # Make current node susceptible and update population statistics.
-      g.nodes[node]['label'] = "susceptible"
-      local_recovered = local_recovered - 1
-      local_susceptible = local_susceptible + 1
-
-    # If susceptible, check if infected by neighbors based on probability given
-    elif (g.nodes[node]['label'] == "susceptible"):
-
-      # Iterate through each of the neighboring nodes.
-      newly_infected = []
-      for neighbor in g[node]:
-        # If neighbor is infected, sample probability that current node gets infected.
-        if (g.nodes[neighbor]['label'] == "infected" and random.random() < beta):
-          # Change current node's state if probability falls in given threshold 
-          newly_infected.append(node)
-          local_susceptible = local_susceptible - 1
-          local_infected = local_infected + 1
-
-          # break since every node can only get infected once. Prevents double counting.
-          break
-    
-      # Only update states after timestep since nodes only become infected after 1 timestep.
-      for x in newly_infected:
-        g.nodes[x]['label'] = "infected"
-
-  # Only remove node after timestep to avoid errors.
-  for node in nodes_to_remove:
-    # First update population information
-    if (g.nodes[node]['label'] == "susceptible"):
-      local_susceptible = local_susceptible - 1
-    elif (g.nodes[node]['label'] == "infected"):
-      local_infected = local_infected - 1
-    elif (g.nodes[node]['label'] == "recovered"):
-      local_recovered = local_recovered - 1
-    
-    # Then remove node.
-    g.remove_node(node)
-
-  # update graph dictionary:
-  graphs[num_graph]["susceptible"] = local_susceptible
-  graphs[num_graph]["infected"] = local_infected
-  graphs[num_graph]["recovered"] = local_recovered
+  Inputs:
+  - num_graph: The graph's position in the global list of subpopulations. 
+  - state: int8 numpy array, the state of each individual in the subpopulation.
+  - params: Tuple (gamma, beta, recovery, r_to_s, move_probability) of contact and transition probabilities.
+  - rng: The numpy random Generator of the subpopulation.
+
+  Outputs:
+  - state: int8 numpy array, the new states of the individuals that stayed in the subpopulation.
+  - move_mask: Boolean numpy array, True for each individual of the input state that moved out.
+  - migrants: List of 4 int8 numpy arrays, the states of the individuals moving to each subpopulation.
+  - rng: The random Generator, advanced past the numbers drawn in this timestep.
+  '''
+
+  (gamma, beta, recovery, r_to_s, move_probability) = params
+  state = state.copy()
+
+  # Probability that a susceptible node has a successful contact with an infected node.
+  infection_probability = 1 - (1 - gamma * beta) ** np.count_nonzero(state == INFECTED)
+
+  # Advance the states of every node that does not move. All the random numbers needed for this 
+  # timestep are drawn in a single batch: each raw 64-bit output of the generator is split into two 
+  # 32-bit draws, and probabilities are compared as integer thresholds. This assumes a bit generator 
+  # whose raw outputs use all 64 bits, like the default PCG64 (MT19937 only fills the low 32 bits).
+  draws = rng.bit_generator.random_raw(2 * len(state)).view(np.uint32).reshape(-1, 4)
+  move_mask = stepStates(state, draws, infection_probability * DRAW_RANGE, round(recovery * DRAW_RANGE),
+                         round(r_to_s * DRAW_RANGE), round(move_probability * DRAW_RANGE))
+
+  # Pick the new subpopulation of each moving node, keeping its current state.
+  moving = state[move_mask]
+  destinations = findContextToMoveTo(num_graph + 1, rng, len(moving)) - 1
+  migrants = [moving[destinations == k] for k in range(4)]
+
+  # Then remove the moving nodes from the current subpopulation.
+  return state[~move_mask], move_mask, migrants, rng
       
+def performGlobalIterationCuda(state, group, params):
+  '''
+  Runs the simulation for a single timestep for all the subpopulations at once on the GPU, with CuPy. 
+  The individuals of every subpopulation are kept in a single device state array, together with the 
+  subpopulation each of them is in, so each step of "performGraphIteration" becomes one elementwise 
+  operation over the whole global population and nothing is copied back to the host.
+
+  Inputs:
+  - state: int8 cupy array, the state of each individual of the global population.
+  - group: Integer cupy array, the subpopulation (0 to 3) each individual is in.
+  - params: Tuple (gamma, beta, recovery, r_to_s, move_probability) of contact and transition probabilities.
+
+  Outputs:
+  - state: int8 cupy array, the new state of each individual.
+  - group: Integer cupy array, the subpopulation each individual is in after moving.
+  '''
+
+  (gamma, beta, recovery, r_to_s, move_probability) = params
+  N = len(state)
+
+  # Probability that a susceptible node has a successful contact with an infected node of its 
+  # subpopulation (see "performGraphIteration").
+  infected = cp.bincount(group[state == INFECTED], minlength=len(MOVE_DESTINATIONS))
+  infection_probability = 1 - (1 - gamma * beta) ** infected
+
+  # Column 0 decides moves, 1 recoveries, 2 loss of immunity, 3 infections and 4 the new subpopulation.
+  r = cp.random.random((N, 5))
+  move_mask = r[:, 0] < move_probability
+  recov_mask = (state == INFECTED) & ~move_mask & (r[:, 1] < recovery)
+  sus_mask = (state == RECOVERED) & ~move_mask & (r[:, 2] < r_to_s)
+  infect_mask = (state == SUSCEPTIBLE) & ~move_mask & (r[:, 3] < infection_probability[group])
+  new_state = state.copy()
+  new_state[recov_mask] = RECOVERED
+  new_state[sus_mask] = SUSCEPTIBLE
+  new_state[infect_mask] = INFECTED
+
+  # Moving individuals only change the subpopulation they belong to.
+  bucket = cp.searchsorted(cp.asarray(MOVE_CUMULATIVE), r[:, 4])
+  destinations = cp.asarray(MOVE_DESTINATIONS)[group, bucket] - 1
+  new_group = cp.where(move_mask, destinations, group)
+  return new_state, new_group
+
 '''
 MAIN CODE
 '''
+# Create the figure once and keep updating it, so the simulation does not wait for each figure to be closed.
+plt.ion()
+fig = plt.figure(figsize=(10,8))
+axes = [fig.add_subplot(3, 2, i + 1) for i in range(5)]
+
 # Main while loop
 t = 0
 while t <= num_iter:
   if (t == 0):
-    # Generate initial conditions for each graph (1 infected each. The rest are susceptible)
+    # Generate initial conditions for each graph (1 infected each. The rest are susceptible). Each graph
+    # holds at least the infected individual.
+    size = max(n, 1)
     for i in range(4):
-      (g, cmap) = generateErdosRenyi(n-1, 1, 0, gamma)
-      graph = {
-        "graph": g, 
-        "cmap": cmap, 
-        "susceptible": n-1,
-        "infected": 1,
-        "recovered" : 0
-        }
+      if device == "cuda":
+        graph = Subpopulation(state=None, counts=np.array([size - 1, 1, 0]))
+      else:
+        state = np.zeros(size, dtype=np.int8)
+        state[-1] = INFECTED
+        graph = Subpopulation(state=state, counts=np.bincount(state, minlength=3))
       graphs.append(graph)
 
-    # Update global states:
-    global_infected.append(4)
-    global_recovered.append(0)
-    global_susceptible.append(4 * (n-1))
-    timesteps.append(0)
+    # On the GPU, build every individual's state and subpopulation on the device and keep them there.
+    if device == "cuda":
+      cuda_state = cp.zeros((len(graphs), size), dtype=cp.int8)
+      cuda_state[:, -1] = INFECTED
+      cuda_state = cuda_state.ravel()
+      cuda_group = cp.repeat(cp.arange(len(graphs)), size)
 
   else: # For every other timestep:
-    # Keep track of statistics for current timestep
-    curr_global_susceptible = 0
-    curr_global_infected = 0
-    curr_global_recovered = 0
-
-    for n in range(len(graphs)):
-      # Perform 1 timestep of epidemic spread
-      performGraphIteration(graphs[n]["graph"], n)
-
-      # Extract total S,I,R populations after updating local graphs
-      curr_global_susceptible = curr_global_susceptible + graphs[n]["susceptible"]
-      curr_global_infected = curr_global_infected + graphs[n]["infected"]
-      curr_global_recovered = curr_global_recovered + graphs[n]["recovered"]
-
-    # Redraw graphs after all state updates complete to prevent undrawable graphs:
-    for n in range(len(graphs)):
-      # Regenerate graph edges randomly (with same states) to simulate random mixing
-      (g, cmap) = generateErdosRenyi(graphs[n]["susceptible"], graphs[n]["infected"], graphs[n]["recovered"], gamma)
-
-      # Save new graphs to graph dictionary
-      graphs[n]["graph"] = g
-      graphs[n]["cmap"] = cmap
-
-    # Update global variables
-    global_susceptible.append(curr_global_susceptible)
-    global_infected.append(curr_global_infected)
-    global_recovered.append(curr_global_recovered)
-    timesteps.append(t)
-
-  # Draw graphs:
-  plt.figure(figsize=(10,8))
+    # Perform 1 timestep of epidemic spread, serially or in parallel over the subpopulations
+    params = (gamma, beta, recovery, r_to_s, move_probability)
+    if device == "cuda":
+      (cuda_state, cuda_group) = performGlobalIterationCuda(cuda_state, cuda_group, params)
+      # Only the S,I,R counts of each subpopulation are copied back to the host.
+      counts = cp.asnumpy(cp.bincount(cuda_group * 3 + cuda_state, minlength=3 * len(graphs))).reshape(-1, 3)
+      for n in range(len(graphs)):
+        graphs[n].counts = counts[n]
+    else:
+      if parallel is None:
+        results = [performGraphIteration(n, graphs[n].state, params, subpopulation_rngs[n]) for n in range(len(graphs))]
+      else:
+        results = parallel(
+          delayed(performGraphIteration)(n, graphs[n].state, params, subpopulation_rngs[n])
+          for n in range(len(graphs)))
+
+      # Save the new states to the subpopulations
+      for n in range(len(graphs)):
+        (graphs[n].state, move_mask, _, subpopulation_rngs[n]) = results[n]
+        if graphs[n].pos is not None:
+          graphs[n].pos = graphs[n].pos[~move_mask]
+
+      # Only then add the moving nodes to their new subpopulations, with a single append per subpopulation
+      for k in range(len(graphs)):
+        arrivals = [results[n][2][k] for n in range(len(graphs))]
+        graphs[k].state = np.concatenate([graphs[k].state] + arrivals)
+        # Place the new individuals at random positions in the drawing.
+        if graphs[k].pos is not None:
+          num_arrivals = len(graphs[k].state) - len(graphs[k].pos)
+          graphs[k].pos = np.concatenate([graphs[k].pos, drawing_rng.uniform(-1, 1, size=(num_arrivals, 2))])
+
+      # Count the S,I,R populations of each local graph
+      for n in range(len(graphs)):
+        graphs[n].counts = np.bincount(graphs[n].state, minlength=3)
+
+  # Keep track of statistics for current timestep
+  curr_global_susceptible = 0
+  curr_global_infected = 0
+  curr_global_recovered = 0
   for n in range(len(graphs)):
-    population = graphs[n]["susceptible"] + graphs[n]["infected"] + graphs[n]["recovered"] 
-    plt.subplot(int("32" + str(n+1)))
-    plt.title("Graph" + str(n+1) + ", iter=" + str(t) + " , n = " + str(population), fontsize = 10)
-    plt.xlabel("S = " + str(graphs[n]["susceptible"]) + ", I = " + str(graphs[n]["infected"]) + ", R = " + str(graphs[n]["recovered"]), fontsize=9)
-    nx.draw_networkx(graphs[n]["graph"], node_color=graphs[n]["cmap"])
+    # Extract total S,I,R populations after updating local graphs
+    curr_global_susceptible = curr_global_susceptible + graphs[n].counts[SUSCEPTIBLE]
+    curr_global_infected = curr_global_infected + graphs[n].counts[INFECTED]
+    curr_global_recovered = curr_global_recovered + graphs[n].counts[RECOVERED]
 
-  # Plot global statistics:
-  plt.subplot(int("32" + str(5)))
-  plt.plot(timesteps, global_susceptible, "-b", label="susceptible")
-  plt.plot(timesteps, global_infected, "-r", label="infected")
-  plt.plot(timesteps, global_recovered, "-g", label="recovered")
-  plt.title("Global Statistics")
-  plt.xlabel("timestep")
-  plt.ylabel("# people")
-  plt.legend()
+  # Update global variables
+  global_susceptible[t] = curr_global_susceptible
+  global_infected[t] = curr_global_infected
+  global_recovered[t] = curr_global_recovered
 
-  plt.show()
+  # Plot global statistics:
+  ax = axes[4]
+  ax.clear()
+  ax.plot(timesteps[:t+1], global_susceptible[:t+1], "-b", label="susceptible")
+  ax.plot(timesteps[:t+1], global_infected[:t+1], "-r", label="infected")
+  ax.plot(timesteps[:t+1], global_recovered[:t+1], "-g", label="recovered")
+  ax.set_title("Global Statistics")
+  ax.set_xlabel("timestep")
+  ax.set_ylabel("# people")
+  ax.legend()
+
+  # Only draw the graphs every draw_interval timesteps, and always draw the last one. Drawing them is
+  # by far the most expensive part of a timestep.
+  if (t == num_iter or (draw_interval != 0 and t % draw_interval == 0)):
+    for n in range(len(graphs)):
+      population = graphs[n].counts.sum()
+      ax = axes[n]
+      ax.clear()
+      ax.set_title("Graph" + str(n+1) + ", iter=" + str(t) + " , n = " + str(population), fontsize = 10)
+      ax.set_xlabel("S = " + str(graphs[n].counts[SUSCEPTIBLE]) + ", I = " + str(graphs[n].counts[INFECTED]) + ", R = " + str(graphs[n].counts[RECOVERED]), fontsize=9)
+      # Generating and laying out the graph is quadratic in its size, so large subpopulations (and the
+      # GPU mode, which is meant for them) only show their S,I,R counts.
+      if (device == "cuda" or population > MAX_DRAWN_POPULATION):
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.text(0.5, 0.5, "Graph too large to draw", ha="center", va="center", transform=ax.transAxes)
+        continue
+      # Generate graph edges randomly (with current states) to show the random mixing
+      (offsets, neighbors) = generateErdosRenyi(graphs[n].state, gamma, drawing_rng)
+      (g, cmap) = buildNetworkxGraph(graphs[n].state, offsets, neighbors)
+      # Only lay the graph out the first time it is drawn, then reuse the positions.
+      if graphs[n].pos is None:
+        layout = nx.spring_layout(g, seed=0)
+        graphs[n].pos = np.array([layout[i] for i in range(len(graphs[n].state))]).reshape(-1, 2)
+      nx.draw_networkx(g, pos=dict(enumerate(graphs[n].pos)), node_color=cmap, ax=ax)
+
+  # Let the figure redraw without blocking, then continue with the next timestep.
+  fig.canvas.draw_idle()
+  plt.pause(0.001)
 
   # Increment timestep
-  t = t + 1
\ No newline at end of file
+  t = t + 1
+
+# Keep the final figure open until the user closes it.
+plt.ioff()
+plt.show()
\ No newline at end of file